@@ -3,6 +3,10 @@ import argparse
 import sys
 import time
 import os
+import zlib
+import hashlib
+import cProfile
+import contextlib
 from struct import *
 
 # Description:
@@ -18,6 +22,17 @@ class PortInRangeAction(argparse.Action):
             raise argparse.ArgumentError(self, f"{port} is not in range of [1024, 65535]")
         setattr(namespace, self.dest, port)
 
+# Description:
+# Custom action to check if number of DUPACKs before fast retransmit is at least 1
+# Arguments:
+# dupacks: holds the number retrieved from command-line option
+# Returns ArgumentError if less than 1; Returns dupacks if valid
+class DupacksInRangeAction(argparse.Action):
+    def __call__(self, parser, namespace, dupacks, option_string=None):
+        if dupacks < 1:
+            raise argparse.ArgumentError(self, f"{dupacks} must be at least 1")
+        setattr(namespace, self.dest, dupacks)
+
 # Description
 # Custom action to check if args.reliable_method is valid
 # Arguments:
@@ -43,8 +58,10 @@ def handle_method(server_socket, client_socket, client_address, args):
     
     # If invoked as server
     if args.server:
-        # Store reliable method
+        # Store reliable method, both sides must also agree on per-packet checksums
         method = args.reliable_method
+        if args.checksum:
+            method += '+CRC'
         print(f'Reliable method: {method}')
         
         # Receive client's reliable method
@@ -65,8 +82,10 @@ def handle_method(server_socket, client_socket, client_address, args):
     
     # If invoked as client
     elif args.client:
-        # Store reliable method
+        # Store reliable method, both sides must also agree on per-packet checksums
         method = args.reliable_method
+        if args.checksum:
+            method += '+CRC'
         print(f'Reliable method: {method}')
         
         # Send reliable method
@@ -96,8 +115,20 @@ def handle_method(server_socket, client_socket, client_address, args):
 # 'H' Unsigned short int, 2 bytes
 header_format = '!IIHH'
 
+# Description:
+# Structure for optional checksum (4 bytes), placed right after the header
+# 'I' Unsigned int, CRC32 of header and data
+checksum_format = '!I'
+checksum_size = 4
+
 # Packet_size = size_of_data + header_format = 1460 + 12
+# With checksum enabled the data is shortened to 1456 bytes, so packet_size stays the same
 packet_size = 1472
+data_size = 1460
+
+# Minimum retransmission timeout in seconds for GBN and GBN-SR sender, 4 * RTT is never set lower
+# On localhost RTT is below a millisecond, which would cause timeouts while ACKs are on their way
+timeout_min = 0.1
 
 # Description:
 # Convert values into packed binary format
@@ -107,15 +138,43 @@ packet_size = 1472
 # Flags: conditions of packet
 # Win: window size
 # Data: file data
+# Checksum: if True, CRC32 of header and data is inserted between them
 # Returns a bytes object packed according to header_format
-def packet_create(seq, ack, flags, win, data):
+def packet_create(seq, ack, flags, win, data, checksum=False):
     
     header = pack(header_format, seq, ack, flags, win)
     
+    if checksum:
+        header += pack(checksum_format, zlib.crc32(header + data))
+    
     packet = header + data
     
     return packet
 
+# Description:
+# Checks the CRC32 of a packet created with checksum=True
+# Arguments:
+# Packet: packet containing header, checksum and data
+# Returns True if packet is intact, False if corrupted
+def packet_verify(packet):
+    
+    if len(packet) < 12 + checksum_size:
+        return False
+    
+    crc, = unpack(checksum_format, packet[12:12 + checksum_size])
+    
+    return crc == zlib.crc32(packet[:12] + packet[12 + checksum_size:])
+
+# Description:
+# Strips header (and checksum if used) from packet
+# Returns data of packet
+def packet_data(packet, checksum=False):
+    
+    if checksum:
+        return packet[12 + checksum_size:]
+    
+    return packet[12:]
+
 # Description:
 # Takes header of 12 bytes and unpacks values
 # Arguments:
@@ -127,6 +186,19 @@ def header_parse(header):
     
     return msg_header
 
+# Description:
+# Takes one or more headers received together and unpacks each of them
+# ACKs and DUPACKs are only a header, so several can arrive in one recv, and one can be split between two
+# Arguments:
+# Msg: bytes containing headers only, starting with the rest returned by the previous call
+# Returns list of tuples, one per header, and the bytes of an incomplete header at the end
+def headers_parse(msg):
+    
+    rest = len(msg) % 12
+    msg_headers = list(iter_unpack(header_format, msg[:len(msg) - rest]))
+    
+    return msg_headers, msg[len(msg) - rest:]
+
 # Description:
 # Applies certain conditions based on binary
 # Returns values for different indexes, depending on condition applied
@@ -139,6 +211,102 @@ def flags_parse(flags):
 
     return syn, ack, fin, res
 
+# Description:
+# Times one phase of the send and receive loops, used as: with profiler.phase('send'):
+# A socket call ending in socket.timeout is counted as timeout instead of its own phase
+# Arguments:
+# profiler: Profiler which records the time
+# name: phase to be timed under
+class Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = self.profiler.clock()
+
+    def __exit__(self, exc_type, exc, traceback):
+        name = self.name
+        if exc_type is not None and issubclass(exc_type, socket.timeout):
+            name = 'timeout'
+        self.profiler.times[name] += self.profiler.clock() - self.start
+        self.profiler.calls[name] += 1
+        return False
+
+# Description:
+# Measures where time is spent in the send and receive loops when invoked with --profile
+# Phases:
+# build/parse: packet_create, header_parse, headers_parse, flags_parse, packet_verify, packet_data
+# send: socket send
+# recv: socket recv, time blocked until data arrived
+# timeout: socket recv ending in timeout and forced sleeps
+# disk: file read and write
+# log: console output
+# When disabled, phase() returns a context manager that does nothing
+class Profiler:
+    phases = ('build/parse', 'send', 'recv', 'timeout', 'disk', 'log')
+
+    def __init__(self):
+        self.enabled = False
+        self.clock = time.perf_counter
+        self.times = dict.fromkeys(self.phases, 0.0)
+        self.calls = dict.fromkeys(self.phases, 0)
+        self.start_time = None
+        self.cprofile = None
+        self.disabled = contextlib.nullcontext()
+
+    # Returns context manager timing the code inside it under phase name
+    def phase(self, name):
+        if not self.enabled:
+            return self.disabled
+        return Phase(self, name)
+
+    # Enables profiling, timing begins when the transfer starts in start()
+    def enable(self, args):
+        self.enabled = True
+        self.method = args.reliable_method
+        self.role = 'server' if args.server else 'client'
+        self.dump = args.profile_dump
+
+    # Starts total time, and cProfile if requested, when the transfer starts
+    # Connecting, handshake and method exchange are therefore not counted by either
+    def start(self):
+        if not self.enabled:
+            return
+        self.start_time = self.clock()
+        if self.dump:
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+
+    # Prints time per phase, and writes cProfile stats if requested
+    def report(self):
+        if not self.enabled or self.start_time is None:
+            return
+        total = self.clock() - self.start_time
+        if self.cprofile:
+            self.cprofile.disable()
+            self.cprofile.dump_stats(self.dump)
+
+        print('---------------------------------------')
+        print(f'Profile ({self.method}, {self.role})')
+        print(f'{"phase":<12}{"time (s)":>12}{"share":>9}{"calls":>9}')
+        for phase in self.phases:
+            print(f'{phase:<12}{self.times[phase]:>12.4f}{self.times[phase] / total:>9.1%}{self.calls[phase]:>9}')
+        other = total - sum(self.times.values())
+        print(f'{"other":<12}{other:>12.4f}{other / total:>9.1%}')
+        print(f'{"total":<12}{total:>12.4f}')
+        if self.cprofile:
+            print(f'cProfile stats written to {self.dump}')
+            print('Times include cProfile overhead')
+        print('---------------------------------------')
+
+profiler = Profiler()
+
+# Function to print to console, counted as logging when profiling
+def log(*values):
+    with profiler.phase('log'):
+        print(*values)
+
 # Description:
 # Function to establish a reliable connection between server and client
 # If successfully established, call function handle_method()
@@ -200,57 +368,84 @@ def three_way_handshake(server_socket, client_socket, client_address, args):
 
 # Description:
 # Function to establish termination of connection between server and client
+# The client's FIN carries the digest of the file it sent, the server compares it
+# with the digest of the data it received
+# Arguments:
+# msg: FIN received by server, None for client
+# digest: hashlib object updated with file data while streaming
 # If successfully established, close corresponding sockets.
-def two_way_byeshake(server_socket, client_socket, client_address, args):
+# Returns True for server if the digests match, False if the received file differs
+def two_way_byeshake(server_socket, client_socket, client_address, args, msg=None, digest=None):
 
     if args.server:
         server_socket.settimeout(0.5)
         try:
+            verified = True
+            if msg is not None and digest is not None:
+                with profiler.phase('build/parse'):
+                    verified = packet_data(msg, args.checksum) == digest.digest()
+                if verified:
+                    log(f'File integrity verified (sha256 {digest.hexdigest()})')
+                else:
+                    log('File integrity check failed, received file differs from sent file')
             send_ack(client_socket, client_address,args)
-            print(f'Client {client_address} has disconnected')
+            log(f'Client {client_address} has disconnected')
             server_socket.close()
             client_socket.close()
+            return verified
         except socket.timeout:
-            two_way_byeshake(server_socket,client_socket,client_address,args)
+            return two_way_byeshake(server_socket,client_socket,client_address,args,msg,digest)
         
     elif args.client:
         client_socket.settimeout(0.5)
         try:
             flags = 2
-            msg = packet_create(0, 0, flags, 0, b'')
-            client_socket.send(msg)
-            print(f'{args.ip} <-[FIN]')
-            
-            msg = client_socket.recv(packet_size)
-            seq, ack, flags, win = header_parse(msg)
+            with profiler.phase('build/parse'):
+                msg = packet_create(0, 0, flags, 0, digest.digest() if digest else b'', args.checksum)
+            with profiler.phase('send'):
+                client_socket.send(msg)
+            log(f'{args.ip} <-[FIN]')
             
-            if ack == 1:
-                print(f'{args.ip} +[ACK]\nClosing...')
+            with profiler.phase('recv'):
+                msg = client_socket.recv(packet_size)
+            with profiler.phase('build/parse'):
+                headers, rest = headers_parse(msg)
+
+            # Only ACK closes, a DUPACK means the FIN was corrupted and is resent
+            if any(seq == 0 and ack == 1 for seq, ack, flags, win in headers):
+                log(f'{args.ip} +[ACK]\nClosing...')
                 client_socket.close()
                 sys.exit(1)
+            two_way_byeshake(None,client_socket,None,args,None,digest)
         except socket.timeout:
-            two_way_byeshake(None,client_socket,None,args)
+            two_way_byeshake(None,client_socket,None,args,None,digest)
 
 
 # Function to send ACK-header without application data
 def send_ack(client_socket, client_address, args):
     if args.server:
-        msg = packet_create(0, 1, 0, 0, b'')
-        client_socket.send(msg)
-        print(f'{client_address} <-[ACK]')
+        with profiler.phase('build/parse'):
+            msg = packet_create(0, 1, 0, 0, b'')
+        with profiler.phase('send'):
+            client_socket.send(msg)
+        log(f'{client_address} <-[ACK]')
     elif args.client:
-        msg = packet_create(0, 1, 0, 0, b'')
-        client_socket.send(msg)
-        print(f'{args.ip} <-[ACK]')
+        with profiler.phase('build/parse'):
+            msg = packet_create(0, 1, 0, 0, b'')
+        with profiler.phase('send'):
+            client_socket.send(msg)
+        log(f'{args.ip} <-[ACK]')
 
 # Description:
 # Function to send DUPACK-header without application data
 # Arguments:
 # seq_num: Usually missing packet
 def send_dupack(client_socket, client_address, seq_num):
-    msg = packet_create(seq_num, 1, 0, 0, b'')
-    client_socket.send(msg)
-    print(f'{client_address} <-[DUPACK #{seq_num}]')
+    with profiler.phase('build/parse'):
+        msg = packet_create(seq_num, 1, 0, 0, b'')
+    with profiler.phase('send'):
+        client_socket.send(msg)
+    log(f'{client_address} <-[DUPACK #{seq_num}]')
 
 # Function to start server and listen for 1 client
 def server_start(args: argparse.Namespace):
@@ -283,7 +478,10 @@ def server_start(args: argparse.Namespace):
 # Function for server to handle incoming data with requested reliable method
 # Returns file sent by client
 def server_handle_client(server_socket, client_socket, client_address, args):
+    profiler.start()
     dataArray = []
+    # Digest of data received in order, compared with client's digest in two_way_byeshake()
+    digest = hashlib.sha256()
     server_socket.setblocking(False)
     # Read more under project report
     def send_and_wait(seq_num):
@@ -299,22 +497,33 @@ def server_handle_client(server_socket, client_socket, client_address, args):
                 if start_time != 0:
                     server_socket.settimeout(4 * (time.monotonic() - start_time))
                     
-                msg = client_socket.recv(packet_size)
+                with profiler.phase('recv'):
+                    msg = client_socket.recv(packet_size)
                 packets_recv += 1
-                seq, ack, flags, win= header_parse(msg)
-                flags = flags_parse(flags)
+                with profiler.phase('build/parse'):
+                    seq, ack, flags, win= header_parse(msg)
+                    flags = flags_parse(flags)
+                    corrupt = args.checksum and not packet_verify(msg)
+                # Drop corrupted packet and ask for seq_num again, it is recovered as if it was lost
+                if corrupt:
+                    log(f'{client_address} +[CORRUPT PACKET #{seq}]')
+                    send_dupack(client_socket, client_address, seq_num)
+                    continue
             
             except socket.timeout:
                 if seq_num == 1:
                     # Will force timeout for both server and client to resend first packet
-                    time.sleep(0.3) 
+                    with profiler.phase('timeout'):
+                        time.sleep(0.3) 
                 else:
                     send_dupack(client_socket, client_address, seq_num)    
             
             if seq_num == seq:
-                print(f'{client_address} +[PACKET #{seq}]')
-                data_msg = msg[12:]
+                log(f'{client_address} +[PACKET #{seq}]')
+                with profiler.phase('build/parse'):
+                    data_msg = packet_data(msg, args.checksum)
                 dataArray.append(data_msg)
+                digest.update(data_msg)
                 start_time = time.monotonic()
                 send_ack(client_socket, client_address, args)
                 seq_num += 1
@@ -323,11 +532,10 @@ def server_handle_client(server_socket, client_socket, client_address, args):
                 send_dupack(client_socket, client_address, seq_num)
                 
             elif seq == 0 and ack == 0 and flags[2] == 2:
-                print(f'{client_address} +[FIN]')
+                log(f'{client_address} +[FIN]')
                 throughput = packets_recv / (time.time() - throughput_start)
-                print(f"Receiver throughput (Send and wait): {throughput} packets/s")    
-                two_way_byeshake(server_socket,client_socket,client_address,args)
-                break
+                log(f"Receiver throughput (Send and wait): {throughput} packets/s")    
+                return two_way_byeshake(server_socket,client_socket,client_address,args,msg,digest)
     # Read more under project report        
     def go_back_n(seq_num):
         throughput_start = time.time()
@@ -337,32 +545,43 @@ def server_handle_client(server_socket, client_socket, client_address, args):
             try:
                 if start_time != 0:
                     server_socket.settimeout(4 * (time.time() - start_time))
-                msg = client_socket.recv(packet_size)
+                with profiler.phase('recv'):
+                    msg = client_socket.recv(packet_size)
                 packets_recv += 1
-                seq, ack, flags, win= header_parse(msg)
-                flags = flags_parse(flags)
+                with profiler.phase('build/parse'):
+                    seq, ack, flags, win= header_parse(msg)
+                    flags = flags_parse(flags)
+                    corrupt = args.checksum and not packet_verify(msg)
+                # Drop corrupted packet and ask for seq_num again, it is recovered as if it was lost
+                if corrupt:
+                    log(f'{client_address} +[CORRUPT PACKET #{seq}]')
+                    send_dupack(client_socket, client_address, seq_num)
+                    continue
             
             except socket.timeout:
                 send_dupack(client_socket, client_address, seq_num)
                     
             if seq == seq_num:
-                print(f'{client_address} +[PACKET #{seq}]')
-                data_msg = msg[12:]
+                log(f'{client_address} +[PACKET #{seq}]')
+                with profiler.phase('build/parse'):
+                    data_msg = packet_data(msg, args.checksum)
                 dataArray.append(data_msg)
+                digest.update(data_msg)
                 start_time = time.time()
                 send_ack(client_socket, client_address, args)
                 seq_num += 1
 
-            elif seq != seq_num and flags[2] != 2:
+            # Packets before seq_num are copies already received, they are ignored so their
+            # DUPACKs do not trigger a fast retransmit
+            elif seq > seq_num and flags[2] != 2:
                 send_dupack(client_socket, client_address, seq_num)
                 
             
             elif seq == 0 and ack == 0 and flags[2] == 2:
                 throughput = packets_recv / (time.time() - throughput_start)
-                print(f"Receiver throughput (Go back N): {throughput} packets/s")  
-                print(f'{client_address} +[FIN]')
-                two_way_byeshake(server_socket,client_socket,client_address,args)
-                break
+                log(f"Receiver throughput (Go back N): {throughput} packets/s")  
+                log(f'{client_address} +[FIN]')
+                return two_way_byeshake(server_socket,client_socket,client_address,args,msg,digest)
     # Read more under project report    
     def go_back_n_sr(seq_num):
         
@@ -375,36 +594,57 @@ def server_handle_client(server_socket, client_socket, client_address, args):
         tempDataArray = {} # Dictionary of seq-num and data, to be sorted
         
         while True:
-            msg = client_socket.recv(packet_size)
-            seq, ack, flags, win = header_parse(msg)
-            flags = flags_parse(flags)
+            with profiler.phase('recv'):
+                msg = client_socket.recv(packet_size)
             packets_recv += 1
+            with profiler.phase('build/parse'):
+                seq, ack, flags, win = header_parse(msg)
+                flags = flags_parse(flags)
+                corrupt = args.checksum and not packet_verify(msg)
+            # Drop corrupted packet and ask for seq_num again, it is recovered as if it was lost
+            if corrupt:
+                log(f'{client_address} +[CORRUPT PACKET #{seq}]')
+                send_dupack(client_socket, client_address, seq_num)
+                continue
             if seq_end == 0:
                 seq_end = win
             
             if seq == seq_num:
                 if seq_num not in tempDataArray:
-                    data_msg = msg[12:]
+                    with profiler.phase('build/parse'):
+                        data_msg = packet_data(msg, args.checksum)
                     tempDataArray.update({seq:data_msg})
-                    print(f'{client_address} +[PACKET #{seq}]')
+                    digest.update(data_msg)
+                    log(f'{client_address} +[PACKET #{seq}]')
                     send_ack(client_socket, client_address, args)
                     seq_first += 1
                     seq_end += 1
                     seq_num += 1
+                    # Packets buffered after a missing packet are now in order, ACK them so the
+                    # client only has to retransmit the missing packet
+                    while seq_num in tempDataArray:
+                        digest.update(tempDataArray[seq_num])
+                        send_ack(client_socket, client_address, args)
+                        seq_first += 1
+                        seq_end += 1
+                        seq_num += 1
                 else:
+                    # Packet was buffered earlier, now it is in order
+                    digest.update(tempDataArray[seq_num])
                     send_ack(client_socket, client_address, args)
                     seq_first += 1
                     seq_end += 1
                     seq_num += 1
             
             elif flags[2] == 2:
-                two_way_byeshake(server_socket,client_socket,client_address,args)
+                verified = two_way_byeshake(server_socket,client_socket,client_address,args,msg,digest)
                 break
             
             elif seq_first <= seq <= seq_end:
                 if seq not in tempDataArray:
-                    print(f'{client_address} +[PACKET #{seq}]')
-                    data_msg = msg[12:]
+                    log(f'{client_address} +[PACKET #{seq}]')
+                    with profiler.phase('build/parse'):
+                        data_msg = packet_data(msg, args.checksum)
                     tempDataArray.update({seq:data_msg})
                     send_dupack(client_socket, client_address, seq_num)
         
@@ -415,20 +655,27 @@ def server_handle_client(server_socket, client_socket, client_address, args):
             dataArray.append(value)    
             
         throughput = packets_recv / (time.time() - throughput_start)
-        print(f"Receiver throughput (Go back N): {throughput} packets/s")  
-        print(f'{client_address} +[FIN]')        
+        log(f"Receiver throughput (Go back N): {throughput} packets/s")  
+        log(f'{client_address} +[FIN]')        
+        return verified
                 
     if args.reliable_method == 'SAW':
-        send_and_wait(1)
+        verified = send_and_wait(1)
     elif args.reliable_method == 'GBN':
-        go_back_n(1)
+        verified = go_back_n(1)
     elif args.reliable_method == 'GBN-SR':
-        go_back_n_sr(1)
+        verified = go_back_n_sr(1)
+    
+    # Do not write a file that differs from the sent file, exit with error instead
+    if not verified:
+        log(f'{args.file} was not written')
+        sys.exit(1)
             
     # Write file in same directory with requested name
-    with open(os.path.join(os.getcwd(), args.file), 'wb') as file:
-        for data in dataArray:
-            file.write(data)
+    with profiler.phase('disk'):
+        with open(os.path.join(os.getcwd(), args.file), 'wb') as file:
+            for data in dataArray:
+                file.write(data)
 
 # Function to connect the client to server    
 def client_connect(args: argparse.Namespace):
@@ -446,18 +693,24 @@ def client_connect(args: argparse.Namespace):
 
 # Function for client to handle data to be sent with requested reliable method    
 def client_send(client_socket, args: argparse.Namespace):
+    profiler.start()
     dataArray = []
+    # Digest of file computed while reading, sent to server in two_way_byeshake()
+    digest = hashlib.sha256()
     
-    # Reads data onto a list in increments of 1460 bytes
+    # Reads data onto a list in increments of 1460 bytes (1456 bytes with checksum)
+    read_size = data_size - checksum_size if args.checksum else data_size
     with open(args.file, 'rb') as file:
         while True:
             try:
-                data = file.read(1460)
-                dataArray.append(data)
+                with profiler.phase('disk'):
+                    data = file.read(read_size)
                 if not data:
                     break
+                dataArray.append(data)
+                digest.update(data)
             except IOError as e:
-                print(f'An IOerror occured: {e}')
+                log(f'An IOerror occured: {e}')
                 client_socket.close()
                 sys.exit(1)
     
@@ -466,30 +719,34 @@ def client_send(client_socket, args: argparse.Namespace):
         throughput_start = time.time()
         packets_sent = 0
         while seq_num <= len(dataArray):
-            msg = packet_create(seq_num, 0, 0, 1, dataArray[seq_num-1])
-            client_socket.send(msg)
+            with profiler.phase('build/parse'):
+                msg = packet_create(seq_num, 0, 0, 1, dataArray[seq_num-1], args.checksum)
+            with profiler.phase('send'):
+                client_socket.send(msg)
             start_time = time.monotonic()
             packets_sent += 1
-            print(f'{args.ip} <-[PACKET #{seq_num}]')
+            log(f'{args.ip} <-[PACKET #{seq_num}]')
             try:
-                msg = client_socket.recv(packet_size)
-                seq, ack, flags, win= header_parse(msg)
+                with profiler.phase('recv'):
+                    msg = client_socket.recv(packet_size)
+                with profiler.phase('build/parse'):
+                    seq, ack, flags, win= header_parse(msg)
                 client_socket.settimeout(4 * (time.monotonic() - start_time)) 
                 if seq == 0 and ack == 1:
-                    print(f'{args.ip} +[ACK]')
+                    log(f'{args.ip} +[ACK]')
                     seq_num += 1
                 
                 elif seq > 0 and ack == 1:
-                    print(f'{args.ip} +[DUPACK #{seq}]')
+                    log(f'{args.ip} +[DUPACK #{seq}]')
                     seq_num = seq
                     
             except socket.timeout:
-                print('Timeout, retransmitting packets from current window')
+                log('Timeout, retransmitting packets from current window')
                 pass    
         # Measure throughput by recording how many packets were sent between the time program began and finished    
         throughput = packets_sent / (time.time() - throughput_start)
-        print(f"Sender throughput (Send and wait): {throughput} packets/s")        
-        two_way_byeshake(None,client_socket,None,args)
+        log(f"Sender throughput (Send and wait): {throughput} packets/s")        
+        two_way_byeshake(None,client_socket,None,args,None,digest)
     
     # Read more under project report           
     def go_back_n(seq_num):
@@ -499,43 +756,79 @@ def client_send(client_socket, args: argparse.Namespace):
         seq_win = args.window
         seq_first = seq_num
         seq_end = seq_first + seq_win
-        while seq_first <= len(dataArray):
+        dupack_seq = 0 # Sequence number reported missing by last DUPACK
+        dupacks = 0 # Number of DUPACKs received for dupack_seq
+        send_time = {} # Time each packet was last sent, to measure RTT when it is ACKed
+        last_in_flight = False # True while a copy of the last packet is on its way and no timeout has fired
+        buffer = b'' # Start of a header split between two recv
+        while seq_num <= len(dataArray):
             while seq_first <= seq_end:
                 if seq_first > len(dataArray):
                     break
-                msg = packet_create(seq_first, 0, 0, seq_win, dataArray[seq_first-1])
-                client_socket.send(msg)
-                start_time = time.time()
+                # Last packet is shorter, send it alone, and only one copy until a timeout fires,
+                # so it is not read together with other packets
+                if seq_first == len(dataArray) and (seq_num < seq_first or last_in_flight):
+                    break
+                with profiler.phase('build/parse'):
+                    msg = packet_create(seq_first, 0, 0, seq_win, dataArray[seq_first-1], args.checksum)
+                with profiler.phase('send'):
+                    client_socket.send(msg)
+                send_time[seq_first] = time.time()
                 packets_sent += 1
-                print(f'{args.ip} <-[PACKET #{seq_first}]')
+                log(f'{args.ip} <-[PACKET #{seq_first}]')
+                if seq_first == len(dataArray):
+                    last_in_flight = True
                 seq_first += 1
                     
             while True:
                 try:
-                    msg = client_socket.recv(packet_size)
-                    seq, ack, flags, win = header_parse(msg)
-                    client_socket.settimeout(4 * (time.time() - start_time) ) 
-                    if seq == 0 and ack == 1:
-                        print(f'{args.ip} +[ACK]')
-                        seq_num += 1
-                        seq_end += 1
-                        break
-                        
-                    elif seq > 0 and ack == 1:
-                        print(f'{args.ip} +[DUPACK #{seq}]')
-                        seq_num = seq
-                        seq_end = seq_num + seq_win
-                        break
+                    with profiler.phase('recv'):
+                        msg = client_socket.recv(packet_size)
+                    seq_acked = seq_num
+                    # Every (DUP)ACK received together is counted
+                    with profiler.phase('build/parse'):
+                        headers, buffer = headers_parse(buffer + msg)
+                    for seq, ack, flags, win in headers:
+                        if seq == 0 and ack == 1:
+                            log(f'{args.ip} +[ACK]')
+                            seq_num += 1
+                            seq_end += 1
+                            dupacks = 0
+                            
+                        elif seq > 0 and ack == 1:
+                            log(f'{args.ip} +[DUPACK #{seq}]')
+                            if seq != dupack_seq:
+                                dupack_seq = seq
+                                dupacks = 0
+                            dupacks += 1
+                            seq_num = seq
+                            seq_end = seq_num + seq_win
+                            # Last packet is only DUPACKed when receiver dropped it, so resend it now
+                            if seq == len(dataArray):
+                                last_in_flight = False
+                                seq_first = seq_num
+                            # Fast retransmit: receiver discards packets after the missing one,
+                            # so go back to it now instead of waiting for timeout
+                            elif dupacks == args.dupacks:
+                                seq_first = seq_num
+                                log(f'{dupacks} DUPACKs, fast retransmitting from packet #{seq}')
+                    # Set the time equal to RTT of the first packet ACKed, multiplied by 4
+                    if seq_num > seq_acked:
+                        client_socket.settimeout(max(timeout_min, 4 * (time.time() - send_time[seq_acked])))
+                    break
                     
                 except socket.timeout:
                     seq_first = seq_num
                     seq_end = seq_first + seq_win
-                    print('Timeout, retransmitting packets from current window')
+                    dupacks = 0
+                    # Last packet may have been lost, allow it to be resent
+                    last_in_flight = False
+                    log('Timeout, retransmitting packets from current window')
                     break
                     
         throughput = packets_sent / (time.time() - throughput_start)
-        print(f"Sender throughput (Go back N): {throughput} packets/s")     
-        two_way_byeshake(None,client_socket,None,args)
+        log(f"Sender throughput (Go back N): {throughput} packets/s")     
+        two_way_byeshake(None,client_socket,None,args,None,digest)
     
     
     # Read more under project report    
@@ -546,55 +839,78 @@ def client_send(client_socket, args: argparse.Namespace):
         seq_win = args.window
         seq_first = seq_num
         seq_end = seq_first + seq_win
-        missing_packets = []
+        dupack_seq = 0 # Sequence number reported missing by last DUPACK
+        dupacks = 0 # Number of DUPACKs received for dupack_seq
+        send_time = {} # Time each packet was last sent, to measure RTT when it is ACKed
+        last_in_flight = False # True while a copy of the last packet is on its way and no timeout has fired
+        buffer = b'' # Start of a header split between two recv
         
         while seq_num <= len(dataArray):
-            while missing_packets:
-                for seq_missing in missing_packets:
-                    msg = packet_create(seq_missing, 0, 0, seq_win, dataArray[seq_missing-1])
+            # Send every packet in window that has not been sent yet
+            while seq_first < seq_end and seq_first <= len(dataArray):
+                # Last packet is shorter, send it alone, and only one copy until a timeout fires,
+                # so it is not read together with other packets
+                if seq_first == len(dataArray) and (seq_num < seq_first or last_in_flight):
+                    break
+                with profiler.phase('build/parse'):
+                    msg = packet_create(seq_first, 0, 0, seq_win, dataArray[seq_first-1], args.checksum)
+                with profiler.phase('send'):
                     client_socket.send(msg)
-                    start_time = time.time()
-                    packets_sent += 1
-                    print(f'{args.ip} <-[PACKET #{seq_missing}]')
-                    
-                    msg = client_socket.recv(packet_size)
-                    seq, ack, flags, win = header_parse(msg)
-                    client_socket.settimeout(4 * (time.time() - start_time) ) 
-                    
-                    if seq == 0 and ack == 1:
-                        missing_packets.remove(seq_missing)
-                        seq_num += 1
-                        seq_end += 1
-                
-            while seq_first < seq_end:
-                msg = packet_create(seq_first, 0, 0, seq_win, dataArray[seq_first-1])
-                client_socket.send(msg)
-                start_time = time.time()
+                send_time[seq_first] = time.time()
                 packets_sent += 1
-                print(f'{args.ip} <-[PACKET #{seq_first}]')
+                log(f'{args.ip} <-[PACKET #{seq_first}]')
+                if seq_first == len(dataArray):
+                    last_in_flight = True
                 seq_first += 1
             
-                try:
+            try:
+                with profiler.phase('recv'):
                     msg = client_socket.recv(packet_size)
-                    seq, ack, flags, win = header_parse(msg)
-                    client_socket.settimeout(4 * (time.time() - start_time) ) 
+                seq_acked = seq_num
+                # Every (DUP)ACK received together is counted
+                with profiler.phase('build/parse'):
+                    headers, buffer = headers_parse(buffer + msg)
+                for seq, ack, flags, win in headers:
                     if seq == 0 and ack == 1:
-                        print(f'{args.ip} +[ACK]')
+                        log(f'{args.ip} +[ACK]')
                         seq_num += 1
                         seq_end += 1
-                        break
+                        dupacks = 0
                     elif seq > 0 and ack == 1:
-                        if seq not in missing_packets:
-                            missing_packets.append(seq)
-                            break
-                
-                except socket.timeout:
-                    seq_first = seq_num
-                    seq_end = seq_first + seq_win
+                        log(f'{args.ip} +[DUPACK #{seq}]')
+                        if seq != dupack_seq:
+                            dupack_seq = seq
+                            dupacks = 0
+                        dupacks += 1
+                        # Last packet is only DUPACKed when receiver dropped it, so resend it now
+                        if seq == len(dataArray):
+                            last_in_flight = False
+                            seq_first = seq
+                        # Fast retransmit: resend only the missing packet, receiver has buffered the rest
+                        # of the window, so new packets keep being sent
+                        elif dupacks == args.dupacks:
+                            log(f'{dupacks} DUPACKs, fast retransmitting packet #{seq}')
+                            with profiler.phase('build/parse'):
+                                msg = packet_create(seq, 0, 0, seq_win, dataArray[seq-1], args.checksum)
+                            with profiler.phase('send'):
+                                client_socket.send(msg)
+                            send_time[seq] = time.time()
+                            packets_sent += 1
+                            log(f'{args.ip} <-[PACKET #{seq}]')
+                # Set the time equal to RTT of the first packet ACKed, multiplied by 4
+                if seq_num > seq_acked:
+                    client_socket.settimeout(max(timeout_min, 4 * (time.time() - send_time[seq_acked])))
+            
+            except socket.timeout:
+                seq_first = seq_num
+                seq_end = seq_first + seq_win
+                dupacks = 0
+                # Last packet may have been lost, allow it to be resent
+                last_in_flight = False
                     
         throughput = packets_sent / (time.time() - throughput_start)
-        print(f"Sender throughput (Go back N with Selective Repeat): {throughput} packets/s")             
-        two_way_byeshake(None,client_socket,None,args)            
+        log(f"Sender throughput (Go back N with Selective Repeat): {throughput} packets/s")             
+        two_way_byeshake(None,client_socket,None,args,None,digest)            
                     
     if args.reliable_method == 'SAW':
         send_and_wait(1)
@@ -615,6 +931,8 @@ def main():
         '-p', '--port', type=int, default=24, action=PortInRangeAction, help="Enter server port (default = 24)")
     parser.add_argument(
         '-r', '--reliable_method', type=str, default='stop_and_wait', action=ValidMethodAction, help="Enter one of three reliability functions (stop_and_wait, GBN, GBN-SR)")
+    parser.add_argument(
+        '-x', '--checksum', action='store_true', help="Add CRC32 checksum to every data packet and FIN, corrupted packets are dropped (must match server)")
     
     # Create a group for server-arguments
     server_parser = parser.add_argument_group('Server')
@@ -631,21 +949,39 @@ def main():
         '-f', '--file', type=str, default='file_to_transfer.jpg', help="Enter file from client to be transfered")
     client_parser.add_argument(
         '-w', '--window', type=int, default='5', help="Enter window size of datapackets (default = 3 for GBN and GBN-SR)")
+    client_parser.add_argument(
+        '-d', '--dupacks', type=int, default=3, action=DupacksInRangeAction, help="Enter number of DUPACKs before fast retransmit (default = 3 for GBN and GBN-SR)")
+    
+    # Create a group for profiling-arguments
+    profile_parser = parser.add_argument_group('Profiling')
+    # Add all available options to profile the send and receive loops
+    profile_parser.add_argument(
+        '--profile', action='store_true', help="Report time spent in packet build/parse, send, recv, timeouts, disk I/O and logging")
+    profile_parser.add_argument(
+        '--profile_dump', type=str, default=None, help="Enter file to write cProfile stats to, for pstats/snakeviz/flameprof (implies --profile)")
     
     # Parse the commands line arguments
     args = parser.parse_args()
     
-    # If program is invoked as server
-    if args.server:
-        server_start(args)
-    # If program is invoked as client
-    elif args.client:
-        client_connect(args)
-    # If program is invoked as both  
-    else:
+    # If program is invoked as neither
+    if not args.server and not args.client:
         print("Error: you must run either in server or client mode")
         parser.print_help()
         sys.exit()
+    
+    # Enable profiling before connecting, report when program finishes
+    if args.profile or args.profile_dump:
+        profiler.enable(args)
+    
+    try:
+        # If program is invoked as server
+        if args.server:
+            server_start(args)
+        # If program is invoked as client
+        elif args.client:
+            client_connect(args)
+    finally:
+        profiler.report()
         
 if __name__ == "__main__":
     main()
\ No newline at end of file